@@ -25,6 +25,16 @@ version = __version__
 
 from .salpylib import DeviceState
 from .salpylib import DDSController
+from .salpylib import DDSCommandServer
+from .salpylib import CommandWorkerPool
 from .salpylib import DDSSubscriber
 from .salpylib import DDSSend
+from .salpylib import DDSCommandClient
 from .salpylib import command_sequencer
+from .sharded import DDSShardedSubscriber
+from .lvcache import LatestValueWriter
+from .lvcache import LatestValueCache
+from .snapshot import SnapshotRecorder
+from .merge import MergedStream
+from .fleet import CSCFleet
+from .preload import Preloader
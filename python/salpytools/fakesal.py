@@ -0,0 +1,250 @@
+# This file is part of salpytools
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import sys
+import copy
+import time
+import types
+import itertools
+import threading
+import collections
+
+"""
+An in-process stand-in for the SALPY_{Device} modules generated by
+ts_sal, to run salpytools without a DDS installation (i.e. for load
+tests). Samples published in one manager are delivered to all the
+managers of the same process subscribed to the topic; nothing leaves
+the process.
+
+- install(Device, telemetry, events, commands): build a fake
+  SALPY_{Device} module and make it importable by load_SALPYlib
+"""
+
+# Same values as the ts_sal generated libraries
+SAL__CMD_ACK = 300
+SAL__CMD_INPROGRESS = 301
+SAL__CMD_STALLED = 302
+SAL__CMD_COMPLETE = 303
+SAL__CMD_NOPERM = -300
+SAL__CMD_NOACK = -301
+SAL__CMD_FAILED = -302
+SAL__CMD_ABORTED = -303
+SAL__CMD_TIMEOUT = -304
+SAL__NO_UPDATES = -100
+
+state_values = {'DISABLED': 1, 'ENABLED': 2, 'FAULT': 3, 'OFFLINE': 4, 'STANDBY': 5}
+
+# Default fields of the topics, if not given
+default_fields = {'timestamp': 0.0,
+                  'value': 0.0,
+                  'seq': 0,
+                  'priority': 1}
+
+
+class FakeBus:
+
+    """ Deliver the samples of a topic to every subscribed queue"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queues = collections.defaultdict(list)
+
+    def subscribe(self, name):
+        queue = collections.deque()
+        with self.lock:
+            self.queues[name].append(queue)
+        return queue
+
+    def unsubscribe(self, name, queue):
+        with self.lock:
+            self.queues[name] = [q for q in self.queues[name] if q is not queue]
+
+    def publish(self, name, sample):
+        with self.lock:
+            queues = list(self.queues[name])
+        for queue in queues:
+            queue.append(sample)
+
+
+def make_data_class(name, fields):
+    """ Make a class like the {Device}_{topic}C classes, with the fields as attributes"""
+    def __init__(self):
+        for key, value in fields.items():
+            setattr(self, key, copy.copy(value))
+    return type(name, (object,), {'__init__': __init__})
+
+
+def make_manager_class(Device, bus, cmd_ids):
+
+    class FakeManager:
+
+        """ Stand-in for the SAL_{Device} manager"""
+
+        def __init__(self):
+            self.queues = {}
+            self.acks = {}
+            self.accepted = set()
+
+        def getCurrentTime(self):
+            return time.time()
+
+        def salTelemetryPub(self, name):
+            return 0
+
+        def salEventPub(self, name):
+            return 0
+
+        def salTelemetrySub(self, name):
+            self.queues[name] = bus.subscribe(name)
+            return 0
+
+        def salEventSub(self, name):
+            self.queues[name] = bus.subscribe(name)
+            return 0
+
+        def salProcessor(self, name):
+            # The same call registers the commander and the processor. Each
+            # side must only keep the queue it reads, or the other one grows
+            # forever: the commands are dropped on the first issueCommand
+            # (unless the mgr also accepts them) and the acks are only
+            # subscribed by issueCommand
+            self.queues[name] = bus.subscribe(name)
+            return 0
+
+        def ack_queue(self, name):
+            if name not in self.acks:
+                self.acks[name] = bus.subscribe(name + '_ack')
+                if name not in self.accepted and name in self.queues:
+                    bus.unsubscribe(name, self.queues.pop(name))
+            return self.acks[name]
+
+        def salShutdown(self):
+            return 0
+
+        def get(self, queue, myData):
+            try:
+                sample = queue.popleft()
+            except (IndexError, AttributeError):
+                return SAL__NO_UPDATES
+            myData.__dict__.update(sample)
+            return 0
+
+        def __getattr__(self, attr):
+            kind, _, topic = attr.partition('_')
+            telemetry = "{}_{}".format(Device, topic)
+            event = "{}_logevent_{}".format(Device, topic)
+            command = "{}_command_{}".format(Device, topic)
+            if kind == 'putSample':
+                return lambda myData: bus.publish(telemetry, dict(myData.__dict__)) or 0
+            if kind == 'logEvent':
+                return lambda myData, priority: bus.publish(event, dict(myData.__dict__)) or 0
+            if kind == 'getNextSample':
+                return lambda myData: self.get(self.queues.get(telemetry), myData)
+            if kind == 'getEvent':
+                return lambda myData: self.get(self.queues.get(event), myData)
+            if kind == 'issueCommand':
+                def issueCommand(myData):
+                    # Subscribe to the acks before the command can be acked
+                    self.ack_queue(command)
+                    cmdId = next(cmd_ids)
+                    sample = dict(myData.__dict__)
+                    sample['private_seqNum'] = cmdId
+                    bus.publish(command, sample)
+                    return cmdId
+                return issueCommand
+            if kind == 'acceptCommand':
+                def acceptCommand(myData):
+                    self.accepted.add(command)
+                    if self.get(self.queues.get(command), myData) == 0:
+                        return myData.private_seqNum
+                    return 0
+                return acceptCommand
+            if kind == 'ackCommand':
+                def ackCommand(cmdId, ack, error, result):
+                    bus.publish(command + '_ack',
+                                {'cmdId': cmdId, 'ack': ack, 'error': error, 'result': result})
+                    return 0
+                return ackCommand
+            if kind == 'getResponse':
+                def getResponse(ackData):
+                    try:
+                        sample = self.ack_queue(command).popleft()
+                    except IndexError:
+                        return SAL__NO_UPDATES
+                    ackData.ack = sample['ack']
+                    ackData.error = sample['error']
+                    ackData.result = sample['result']
+                    return sample['cmdId']
+                return getResponse
+            if kind == 'waitForCompletion':
+                getResponse = getattr(self, 'getResponse_{}'.format(topic))
+                ackData = ackcmd()
+
+                def waitForCompletion(cmdId, timeout):
+                    t0 = time.time()
+                    while time.time() - t0 < timeout:
+                        if getResponse(ackData) == cmdId and ackData.ack in (SAL__CMD_COMPLETE,
+                                                                            SAL__CMD_NOPERM,
+                                                                            SAL__CMD_FAILED,
+                                                                            SAL__CMD_ABORTED):
+                            return ackData.ack
+                        time.sleep(0.001)
+                    return SAL__CMD_NOACK
+                return waitForCompletion
+            raise AttributeError(attr)
+
+    ackcmd = make_data_class('{}_ackcmdC'.format(Device), {'ack': 0, 'error': 0, 'result': ''})
+    FakeManager.__name__ = 'SAL_{}'.format(Device)
+    return FakeManager, ackcmd
+
+
+def make_SALPYlib(Device, telemetry=(), events=(), commands=()):
+    """
+    Build a fake SALPY_{Device} module. The topics are given as a list
+    of names (with default_fields) or as a dictionary {topic: {field:
+    default value}}
+    """
+    module = types.ModuleType('SALPY_{}'.format(Device))
+    module.__doc__ = "Fake SALPY_{} module from salpytools.fakesal".format(Device)
+    for name, value in globals().items():
+        if name.startswith('SAL__'):
+            setattr(module, name, value)
+    for name, value in state_values.items():
+        setattr(module, 'SAL__STATE_{}'.format(name), value)
+
+    bus = FakeBus()
+    manager, ackcmd = make_manager_class(Device, bus, itertools.count(1))
+    setattr(module, 'SAL_{}'.format(Device), manager)
+    setattr(module, ackcmd.__name__, ackcmd)
+    for topics, prefix in [(telemetry, ''), (events, 'logevent_'), (commands, 'command_')]:
+        if not isinstance(topics, dict):
+            topics = {topic: default_fields for topic in topics}
+        for topic, fields in topics.items():
+            name = '{}_{}{}C'.format(Device, prefix, topic)
+            setattr(module, name, make_data_class(name, fields))
+    return module
+
+
+def install(Device, telemetry=(), events=(), commands=()):
+    """ Build a fake SALPY_{Device} module and make it importable"""
+    module = make_SALPYlib(Device, telemetry=telemetry, events=events, commands=commands)
+    sys.modules[module.__name__] = module
+    return module
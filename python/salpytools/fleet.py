@@ -0,0 +1,126 @@
+# This file is part of salpytools
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import time
+import logging
+import threading
+import collections
+from salpytools import salpylib
+from salpytools import states
+
+"""
+Host many simulated CSCs in one process for fleet-scale testing.
+
+- CSCFleet: Run the transition state machines of a list of Devices
+  with one polling loop and a shared worker pool (threaded)
+
+Each simulated CSC is a DeviceState plus a DDSCommandServer bound to
+the transition commands. The servers do not run their own threads:
+the fleet polls all of them from a single loop and the transitions are
+run by one CommandWorkerPool shared by the whole fleet.
+"""
+
+LOGGER = logging.getLogger(__name__)
+
+default_eventlist = ['summaryState',
+                     'settingVersions',
+                     'settingsApplied',
+                     'appliedSettingsMatchStart']
+
+
+def read_fleet(filename):
+    """
+    Read the list of Devices to simulate from a json file with a list
+    of entries like:
+    {"Device": "ATHeaderService", "start_state": "OFFLINE",
+     "eventlist": ["summaryState", ...]}
+    Only Device is required
+    """
+    with open(filename) as fp:
+        return json.load(fp)
+
+
+class CSCFleet(threading.Thread):
+
+    """
+    Simulate the transitions of a fleet of CSCs, given as a list of
+    dictionaries with the keys Device, and optionally start_state,
+    eventlist, checkpoint and checkpoint_max_age (see DeviceState).
+    """
+
+    def __init__(self, devices, start_state='OFFLINE', nworkers=4, queue_size=1000, tsleep=0.1,
+                 event_tsleep=0, threadID='1'):
+        threading.Thread.__init__(self)
+        self.threadID = threadID
+        self.daemon = True
+        self.tsleep = tsleep
+        self.running = True
+        self.pool = salpylib.CommandWorkerPool(nworkers=nworkers, queue_size=queue_size)
+        self.State = collections.OrderedDict()
+        self.servers = collections.OrderedDict()
+        for entry in devices:
+            Device = entry['Device']
+            State = salpylib.DeviceState(Device=Device,
+                                         default_state=entry.get('start_state', start_state),
+                                         eventlist=entry.get('eventlist', default_eventlist),
+                                         tsleep=event_tsleep,
+                                         checkpoint=entry.get('checkpoint'),
+                                         checkpoint_max_age=entry.get('checkpoint_max_age'))
+            server = salpylib.DDSCommandServer(Device=Device, pool=self.pool)
+            server.bind_transitions(State)
+            self.State[Device] = State
+            self.servers[Device] = server
+            LOGGER.info("Fleet ready for {} in State {}".format(Device, State.current_state))
+
+    def send_summaryState(self):
+        """Send the summaryState of all the Devices"""
+        for State in self.State.values():
+            State.send_logEvent('summaryState')
+
+    def run(self):
+        """ The run method for the threading"""
+        while self.running:
+            naccepted = 0
+            for server in self.servers.values():
+                naccepted += server.poll()
+            if naccepted == 0:
+                time.sleep(self.tsleep)
+
+    def status(self):
+        """Dictionary with the number of Devices in each state"""
+        counts = collections.OrderedDict((name, 0) for name in states.state_names)
+        for State in self.State.values():
+            counts[State.current_state] = counts.get(State.current_state, 0) + 1
+        return counts
+
+    def status_line(self):
+        """One line summary of the states of the fleet"""
+        return " ".join("{}:{}".format(name, n) for name, n in self.status().items() if n > 0)
+
+    def status_table(self):
+        """Compact table with the state of each Device"""
+        return "\n".join("{:30s} {}".format(Device, State.current_state)
+                         for Device, State in self.State.items())
+
+    def stop(self):
+        """Stop the polling loop"""
+        self.running = False
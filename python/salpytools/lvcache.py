@@ -0,0 +1,254 @@
+# This file is part of salpytools
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import time
+import types
+import struct
+import pickle
+import logging
+import threading
+from multiprocessing import shared_memory
+from multiprocessing import resource_tracker
+from salpytools import salpylib
+
+"""
+A cross-process latest-value cache for Telemetry and Events. A single
+writer process subscribes to a configured set of topics and keeps the
+newest sample of each one in a table in shared memory. Any number of
+reader processes on the same host attach to the table by name and read
+the values without touching DDS.
+
+- LatestValueWriter: Subscribe to the topics and update the table
+  (threaded)
+- LatestValueCache: Lightweight reader handle, get(Device, topic)
+
+Each entry of the table is protected by a seqlock: the writer makes the
+sequence number odd while it updates the entry and even once it is
+done, and readers retry until they read the same even sequence number
+before and after copying the entry.
+"""
+
+LOGGER = logging.getLogger(__name__)
+
+MAGIC = b'SALPYLVC'
+
+# magic, nentries, slot_size, directory size
+HEADER = struct.Struct('<8sIII')
+# seq, write time, payload size
+ENTRY = struct.Struct('<QdI')
+SEQ = struct.Struct('<Q')
+# The fields of ENTRY after seq
+ENTRY_DATA = struct.Struct('<dI')
+
+# Names of the blocks created by a LatestValueWriter in this process
+_created = set()
+
+
+def attach_shared_memory(name):
+    """
+    Attach to an existing shared memory block without registering it
+    with the resource tracker of this process, otherwise the block
+    would be removed when a reader process exits
+    """
+    # Blocks created by this process are already tracked
+    if name in _created:
+        return shared_memory.SharedMemory(name=name)
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # python < 3.13 has no track keyword
+        shm = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+class LatestValueWriter(threading.Thread):
+
+    """
+    Create the shared-memory table for a list of (Device, topic, Stype)
+    and keep it updated with the newest sample of each topic. Each
+    sample must fit in slot_size bytes once pickled.
+    """
+
+    def __init__(self, topics, name=None, slot_size=4096, threadID='1', tsleep=0.01):
+        threading.Thread.__init__(self)
+        self.threadID = threadID
+        self.daemon = True
+        self.tsleep = tsleep
+        self.slot_size = slot_size
+        self.running = True
+        self.topics = [tuple(t) for t in topics]
+        self.subscribe()
+
+        # The directory is written once after the header, the readers
+        # use it to find the slot of each topic
+        directory = pickle.dumps([(Device, topic, Stype, self.keys[Device, topic])
+                                  for Device, topic, Stype in self.topics])
+        self.slots_offset = HEADER.size + len(directory)
+        size = self.slots_offset + len(self.topics) * slot_size
+        self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        self.name = self.shm.name
+        _created.add(self.name)
+        self.buf = self.shm.buf
+        self.buf[HEADER.size:self.slots_offset] = directory
+        self.offset = {}
+        for index, (Device, topic, Stype) in enumerate(self.topics):
+            self.offset[Device, topic] = self.slots_offset + index * slot_size
+            ENTRY.pack_into(self.buf, self.offset[Device, topic], 0, 0, 0)
+        # Write the magic last, readers wait for it
+        HEADER.pack_into(self.buf, 0, MAGIC, len(self.topics), slot_size, len(directory))
+        LOGGER.info("Latest value cache {} ready for {} topics".format(self.name, len(self.topics)))
+
+    def subscribe(self):
+        self.mgr, self.readers = salpylib.subscribe_topics(self.topics)
+        self.keys = {(Device, topic): keys for Device, topic, myData, getSample, keys in self.readers}
+
+    def update(self, Device, topic, values):
+        """Write the list of values (in the order of the keys) of a topic"""
+        offset = self.offset[Device, topic]
+        payload = pickle.dumps(values, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(payload) > self.slot_size - ENTRY.size:
+            LOGGER.warning("Sample for {}_{} does not fit in the slot".format(Device, topic))
+            return False
+        seq, = SEQ.unpack_from(self.buf, offset)
+        SEQ.pack_into(self.buf, offset, seq + 1)
+        start = offset + ENTRY.size
+        self.buf[start:start + len(payload)] = payload
+        # Everything is written while seq is odd, the even seq goes last
+        ENTRY_DATA.pack_into(self.buf, offset + SEQ.size, time.time(), len(payload))
+        SEQ.pack_into(self.buf, offset, seq + 2)
+        return True
+
+    def run(self):
+        """ The run method for the threading"""
+        while self.running:
+            if self.poll() == 0:
+                time.sleep(self.tsleep)
+
+    def poll(self):
+        """Read all new samples and keep only the newest one. Returns the number of samples"""
+        nsamples = 0
+        for Device, topic, myData, getSample, keys in self.readers:
+            new = False
+            while getSample(myData) == 0:
+                new = True
+                nsamples += 1
+            if new:
+                self.update(Device, topic, [salpylib.plain_value(getattr(myData, key)) for key in keys])
+        return nsamples
+
+    def shutdown(self):
+        """Stop updating and remove the table"""
+        self.running = False
+        if self.is_alive():
+            self.join()
+        for Device in self.mgr:
+            self.mgr[Device].salShutdown()
+        self.buf = None
+        self.shm.close()
+        self.shm.unlink()
+        _created.discard(self.name)
+
+
+class LatestValueCache:
+
+    """
+    Reader handle for the table of a LatestValueWriter, attached by the
+    name of the shared memory block. Reads are O(1) and never touch DDS.
+    """
+
+    def __init__(self, name, timeout=5, retries=1000):
+        self.name = name
+        self.retries = retries
+        self.shm = attach_shared_memory(name)
+        self.buf = self.shm.buf
+        t0 = time.time()
+        while True:
+            magic, nentries, slot_size, dirsize = HEADER.unpack_from(self.buf, 0)
+            if magic == MAGIC:
+                break
+            if time.time() - t0 > timeout:
+                raise ValueError("Shared memory {} is not a latest value cache".format(name))
+            time.sleep(0.01)
+        directory = pickle.loads(bytes(self.buf[HEADER.size:HEADER.size + dirsize]))
+        slots_offset = HEADER.size + dirsize
+        self.index = {}
+        for k, (Device, topic, Stype, keys) in enumerate(directory):
+            self.index[Device, topic] = (slots_offset + k * slot_size, Stype, keys)
+
+    def topics(self):
+        """List of (Device, topic, Stype) in the cache"""
+        return [(Device, topic, Stype) for (Device, topic), (offset, Stype, keys) in self.index.items()]
+
+    def read(self, Device, topic):
+        """
+        Consistent read of an entry. Returns the tuple (values, write_time),
+        or (None, None) if the topic has not received any sample
+        """
+        offset, Stype, keys = self.index[Device, topic]
+        for k in range(self.retries):
+            entry = ENTRY.unpack_from(self.buf, offset)
+            seq, write_time, nbytes = entry
+            if seq == 0:
+                return None, None
+            if seq & 1:
+                continue
+            start = offset + ENTRY.size
+            payload = bytes(self.buf[start:start + nbytes])
+            # The whole header must be unchanged after the copy
+            if ENTRY.unpack_from(self.buf, offset) == entry:
+                return pickle.loads(payload), write_time
+        raise RuntimeError("Could not get a consistent read for {}_{}".format(Device, topic))
+
+    def get(self, Device, topic):
+        """Get the newest sample of a topic as an object with the myData attributes, or None"""
+        values, write_time = self.read(Device, topic)
+        if values is None:
+            return None
+        return types.SimpleNamespace(**dict(zip(self.index[Device, topic][2], values)))
+
+    def get_entry(self, Device, topic):
+        """Get the tuple (sample, age) where age is the time (sec) since the entry was updated"""
+        values, write_time = self.read(Device, topic)
+        if values is None:
+            return None, None
+        sample = types.SimpleNamespace(**dict(zip(self.index[Device, topic][2], values)))
+        return sample, time.time() - write_time
+
+    def get_age(self, Device, topic):
+        """Time (sec) since the entry was updated, None if it never was"""
+        offset = self.index[Device, topic][0]
+        for k in range(self.retries):
+            entry = ENTRY.unpack_from(self.buf, offset)
+            seq, write_time, nbytes = entry
+            if seq == 0:
+                return None
+            if not seq & 1 and ENTRY.unpack_from(self.buf, offset) == entry:
+                return time.time() - write_time
+        raise RuntimeError("Could not get a consistent read for {}_{}".format(Device, topic))
+
+    def staleness(self):
+        """Dictionary with the age of every entry"""
+        return {(Device, topic): self.get_age(Device, topic) for Device, topic in self.index}
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
@@ -0,0 +1,197 @@
+# This file is part of salpytools
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import time
+import heapq
+import types
+import asyncio
+import logging
+import itertools
+from salpytools import salpylib
+
+"""
+A single time-ordered stream of Commands, Events and Telemetry from
+several Devices.
+
+- MergedStream: Subscribe to a set of topics and yield (Device, topic,
+  sample) in time order, as a generator or an async iterator
+- TimeOrderedMerge: The bounded-lateness k-way merge behind MergedStream
+
+Samples are held in a heap keyed on their timestamp for a reorder
+window: a sample is released once a sample newer by at least window
+seconds has been seen, or once it has waited window seconds (wall
+clock) since it arrived, so sparse streams are not held back. Memory
+is bounded by the number of samples that arrive within the window and
+not by the length of the stream. Samples older than the last one
+released are counted as late.
+"""
+
+LOGGER = logging.getLogger(__name__)
+
+
+class TimeOrderedMerge:
+
+    """
+    Bounded-lateness merge of samples pushed in any order. Late samples
+    (older than the last sample released) are counted and dropped, or
+    released as soon as possible if drop_late=False. A sample is
+    released when a sample newer by window has been pushed, or window
+    sec after it was pushed (by time.monotonic). If more than
+    max_pending samples are waiting, the oldest ones are released even
+    if they are still inside the window.
+    """
+
+    def __init__(self, window=1.0, max_pending=100000, drop_late=True):
+        self.window = window
+        self.max_pending = max_pending
+        self.drop_late = drop_late
+        self.heap = []
+        # Tie-breaker, so samples with the same time keep the push order
+        self.counter = itertools.count()
+        self.max_time = None
+        self.last_time = None
+        self.nlate = 0
+        self.late = {}
+
+    def __len__(self):
+        return len(self.heap)
+
+    def push(self, Device, topic, t, sample):
+        """ Add a sample with time t"""
+        if self.last_time is not None and t < self.last_time:
+            self.nlate += 1
+            self.late[Device, topic] = self.late.get((Device, topic), 0) + 1
+            if self.drop_late:
+                return
+        heapq.heappush(self.heap, (t, next(self.counter), time.monotonic(), Device, topic, sample))
+        if self.max_time is None or t > self.max_time:
+            self.max_time = t
+
+    def pop_ready(self, flush=False):
+        """ Yield the tuples (Device, topic, t, sample) that are out of the window"""
+        # Anything pushed before the watermark has waited a full window
+        watermark = time.monotonic() - self.window
+        while self.heap:
+            t, count, arrival = self.heap[0][:3]
+            if (flush or len(self.heap) > self.max_pending or t <= self.max_time - self.window or
+                    arrival <= watermark):
+                t, count, arrival, Device, topic, sample = heapq.heappop(self.heap)
+                if self.last_time is None or t > self.last_time:
+                    self.last_time = t
+                yield Device, topic, t, sample
+            else:
+                break
+
+
+class MergedStream:
+
+    """
+    Subscribe to a list of (Device, topic, Stype) with one mgr per
+    Device and yield (Device, topic, sample) in time order. The time of
+    each sample is taken from the first of salpylib.time_keys found in
+    the topic, or the receive time from the SAL mgr otherwise (same TAI
+    time base as private_sndStamp, see now()). The samples are
+    SimpleNamespace objects with the same attributes as the myData C
+    objects. Iteration stops (after releasing the pending samples) once
+    stop() is called or after timeout sec, if set.
+    """
+
+    def __init__(self, topics, window=1.0, max_pending=100000, drop_late=True, tsleep=0.01, timeout=None):
+        self.tsleep = tsleep
+        self.timeout = timeout
+        self.running = True
+        self.merge = TimeOrderedMerge(window=window, max_pending=max_pending, drop_late=drop_late)
+        self.topics = [tuple(t) for t in topics]
+        self.subscribe()
+
+    def subscribe(self):
+        self.mgr, readers = salpylib.subscribe_topics(self.topics)
+        self.readers = [reader + (salpylib.time_key(reader[4]),) for reader in readers]
+
+    @property
+    def nlate(self):
+        """Total number of late samples"""
+        return self.merge.nlate
+
+    @property
+    def late(self):
+        """Number of late samples per (Device, topic)"""
+        return self.merge.late
+
+    def now(self):
+        """ The current time from the SAL mgr (TAI), time.time() if there is no mgr"""
+        return salpylib.mgr_time(next(iter(self.mgr.values()), None))
+
+    def poll(self):
+        """Push all the new samples into the merge. Returns the number of samples"""
+        nsamples = 0
+        for Device, topic, myData, getSample, keys, time_key in self.readers:
+            while getSample(myData) == 0:
+                sample = types.SimpleNamespace(**{key: salpylib.plain_value(getattr(myData, key))
+                                                  for key in keys})
+                t = getattr(sample, time_key) if time_key else self.now()
+                self.merge.push(Device, topic, t, sample)
+                nsamples += 1
+        return nsamples
+
+    def ready(self):
+        """Poll once and return the list of (Device, topic, sample) ready to go"""
+        self.poll()
+        flush = not self.running
+        return [(Device, topic, sample) for Device, topic, t, sample in self.merge.pop_ready(flush=flush)]
+
+    def expired(self, t0):
+        if self.timeout is not None and time.time() - t0 > self.timeout:
+            self.running = False
+        return not self.running
+
+    def __iter__(self):
+        t0 = time.time()
+        while True:
+            done = self.expired(t0)
+            items = self.ready()
+            for item in items:
+                yield item
+            if done:
+                break
+            if not items:
+                time.sleep(self.tsleep)
+
+    async def __aiter__(self):
+        t0 = time.time()
+        while True:
+            done = self.expired(t0)
+            items = self.ready()
+            for item in items:
+                yield item
+            if done:
+                break
+            if not items:
+                await asyncio.sleep(self.tsleep)
+
+    def stop(self):
+        """Stop the iteration, the pending samples are released first"""
+        self.running = False
+
+    def shutdown(self):
+        self.stop()
+        for Device in self.mgr:
+            self.mgr[Device].salShutdown()
@@ -0,0 +1,166 @@
+# This file is part of salpytools
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import time
+import logging
+import concurrent.futures
+from salpytools import salpylib
+
+"""
+Parallel startup driven by a subscription manifest. The manifest lists
+for each Device the topics to register by kind:
+
+{"buffer": {"nkeep": 100, "tsleep": 0.01},
+ "Devices": {
+    "ATCamera": {"Telemetry": ["heartbeat"],
+                 "Event": ["startIntegration", "endReadout"],
+                 "Command": ["start"],
+                 "logEvent": ["summaryState"],
+                 "buffer": {"nkeep": 10}},
+    ...}}
+
+The kinds Telemetry, Event and Command are subscriptions (attached by
+DDSSubscriber, or DDSController for Command), logEvent are event
+publishers (attached by DeviceState). The buffer entries are the
+DDSSubscriber keywords (nkeep, tsleep, timeout) for all Devices or for
+one of them.
+
+- Preloader: Import the SALPY modules and register all the topics of a
+  manifest, one thread per Device
+
+Once preloaded, creating a DDSSubscriber, DDSController or DeviceState
+for a registered topic attaches to the pre-registered mgr instead of
+creating and subscribing a new one, so the time to first sample is
+bounded by the slowest Device and not by the sum of all of them.
+"""
+
+LOGGER = logging.getLogger(__name__)
+
+
+def read_manifest(filename):
+    """Read a manifest from a json file"""
+    with open(filename) as fp:
+        return json.load(fp)
+
+
+def preload_device(Device, topics):
+    """
+    Import SALPY_{Device} and register its topics, given as a dictionary
+    {kind: [topic, ...]}. Subscriptions get one mgr per topic (as
+    DDSSubscriber does) and publishers share one mgr (as DeviceState
+    does). Returns a dictionary with the time spent (sec) importing and
+    registering
+    """
+    t0 = time.time()
+    SALPY_lib = salpylib.load_SALPYlib(Device)
+    t1 = time.time()
+    handles = {}
+    for Stype in ['Telemetry', 'Event', 'Command']:
+        for topic in topics.get(Stype, []):
+            mgr = getattr(SALPY_lib, 'SAL_{}'.format(Device))()
+            myData = salpylib.subscribe_topic(SALPY_lib, mgr, Device, topic, Stype)[0]
+            if Stype == 'Telemetry':
+                name = "{}_{}".format(Device, topic)
+            elif Stype == 'Event':
+                name = "{}_logevent_{}".format(Device, topic)
+            else:
+                name = "{}_command_{}".format(Device, topic)
+            handles[Stype, name] = (mgr, myData)
+    if topics.get('logEvent'):
+        mgr = getattr(SALPY_lib, 'SAL_{}'.format(Device))()
+        for eventname in topics['logEvent']:
+            name = "{}_logevent_{}".format(Device, eventname)
+            mgr.salEventPub(name)
+            handles['logEvent', name] = (mgr, getattr(SALPY_lib, name + 'C')())
+    with salpylib.preloaded_lock:
+        salpylib.preloaded.update(handles)
+    t2 = time.time()
+    LOGGER.info("Preloaded {} topics for {} in {:.3f} sec".format(len(handles), Device, t2 - t0))
+    return {'import': t1 - t0, 'register': t2 - t1, 'total': t2 - t0, 'ntopics': len(handles)}
+
+
+class Preloader:
+
+    """
+    Import the SALPY modules and register the topics of a manifest
+    concurrently, with one thread per Device (up to nthreads). The time
+    spent per Device is kept in the timing dictionary.
+    """
+
+    def __init__(self, manifest, nthreads=None):
+        if isinstance(manifest, str):
+            manifest = read_manifest(manifest)
+        self.manifest = manifest
+        self.Devices = manifest['Devices']
+        self.nthreads = nthreads if nthreads else max(len(self.Devices), 1)
+        self.timing = {}
+        self.errors = {}
+
+    def preload(self):
+        """Run the preload, returns the timing per Device"""
+        t0 = time.time()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.nthreads) as executor:
+            futures = {executor.submit(preload_device, Device, topics): Device
+                       for Device, topics in self.Devices.items()}
+            for future in concurrent.futures.as_completed(futures):
+                Device = futures[future]
+                try:
+                    self.timing[Device] = future.result()
+                except Exception as err:
+                    LOGGER.error("Could not preload {}: {}".format(Device, err))
+                    self.errors[Device] = err
+        self.elapsed = time.time() - t0
+        LOGGER.info("Preloaded {} Devices in {:.3f} sec".format(len(self.timing), self.elapsed))
+        return self.timing
+
+    def buffer(self, Device):
+        """The DDSSubscriber keywords for a Device"""
+        keys = dict(self.manifest.get('buffer', {}))
+        keys.update(self.Devices[Device].get('buffer', {}))
+        return keys
+
+    def subscribers(self):
+        """
+        Create a DDSSubscriber for every Telemetry and Event topic in the
+        manifest, attached to the preloaded handles. Returns a dictionary
+        keyed by (Device, topic)
+        """
+        subscribers = {}
+        for Device, topics in self.Devices.items():
+            if Device in self.errors:
+                continue
+            for Stype in ['Telemetry', 'Event']:
+                for topic in topics.get(Stype, []):
+                    subscribers[Device, topic] = salpylib.DDSSubscriber(Device, topic, Stype=Stype,
+                                                                        **self.buffer(Device))
+        return subscribers
+
+    def report(self):
+        """Text report of the time spent per Device"""
+        lines = ["{:30s} {:>8s} {:>8s} {:>8s} {:>7s}".format(
+            'Device', 'import', 'register', 'total', 'topics')]
+        for Device, t in sorted(self.timing.items(), key=lambda item: -item[1]['total']):
+            lines.append("{:30s} {:8.3f} {:8.3f} {:8.3f} {:7d}".format(
+                Device, t['import'], t['register'], t['total'], t['ntopics']))
+        for Device, err in self.errors.items():
+            lines.append("{:30s} FAILED: {}".format(Device, err))
+        return "\n".join(lines)
@@ -24,9 +24,17 @@ import sys
 import threading
 import logging
 import salpytools.states as states
+from salpytools.stats import FieldStats
 import inspect
 import itertools
 import importlib
+import concurrent.futures
+import collections
+import functools
+import queue
+import json
+import os
+import tempfile
 
 """
 A Set of Python classes and tools to subscribe to LSST/SAL DDS topics
@@ -35,10 +43,14 @@ module are:
 
 - DDSController: Subscribe and acknowleges Commands for a Device
   (threaded)
+- DDSCommandServer: Accept arbitrary Commands for a Device and run
+  their handlers in a worker pool (threaded)
 - DDSSubscriber: Subscribe to Command/Telemetry/Event topics for a
   Device (threaded)
 - DDSSend: Generates/send Telemetry, Events or Commands for a Device
   (non-threaded)
+- DDSCommandClient: Re-usable client to issue many Commands in flight
+  for a Device and collect their acks (threaded)
 - DeviceState: Class Used by DDSController to store the state of the
   Commandable-Component/Device
 
@@ -56,6 +68,22 @@ spinner = itertools.cycle(['-', '/', '|', '\\'])
 # Create a logger for all functions
 LOGGER = logging.getLogger(__name__)
 
+# Topics registered ahead of time by salpytools.preload, keyed by
+# (Stype, topic name), where Stype is Telemetry/Event/Command for
+# subscriptions and logEvent for event publishers. The values are
+# (mgr, myData) tuples with the mgr already subscribed to the topic.
+preloaded = {}
+preloaded_lock = threading.Lock()
+
+
+# Attributes used, in order, as the time of a sample
+time_keys = ['private_sndStamp', 'timestamp', 'timeStamp']
+
+def take_preloaded(Stype, name):
+    """Take (and remove) a pre-registered (mgr, myData) handle, or None"""
+    with preloaded_lock:
+        return preloaded.pop((Stype, name), None)
+
 
 def load_SALPYlib(Device):
     """Trick to import modules dynamically as needed/depending on the Device we want"""
@@ -88,11 +116,19 @@ class DeviceState:
                  eventlist=['summaryState',
                             'settingVersions',
                             'settingsApplied',
-                            'appliedSettingsMatchStart']):
-
+                            'appliedSettingsMatchStart'],
+                 checkpoint=None, restore=True, checkpoint_max_age=None):
+
+        # The checkpoint file (if any) is updated on every transition and
+        # event. It is restored on startup if restore=True and it is not
+        # older than checkpoint_max_age (sec), if set. The lock serializes
+        # the saves from the controller threads and the payload updates
+        self.checkpoint = None
+        self.checkpoint_lock = threading.RLock()
         self.current_state = default_state
         self.tsleep = tsleep
         self.Device = Device
+        self.payloads = {}
 
         LOGGER.info('{} Init beginning'.format(Device))
         LOGGER.info('Starting with default state: {}'.format(default_state))
@@ -101,12 +137,97 @@ class DeviceState:
         self.SALPY_lib = load_SALPYlib(self.Device)
         # Subscribe to all events in list
         self.subscribe_list(eventlist)
-        # Get the enumeration of the states from the library
+        # Restore the state from a previous run, or get the enumeration
+        # of the states from the library
+        self.restored = False
+        if checkpoint and restore and os.path.exists(checkpoint):
+            age = time.time() - os.path.getmtime(checkpoint)
+            if checkpoint_max_age is not None and age > checkpoint_max_age:
+                LOGGER.warning("Ignoring checkpoint: {} -- {:.0f} sec old, max age is {} sec".format(
+                    checkpoint, age, checkpoint_max_age))
+            else:
+                self.restored = self.load_checkpoint(checkpoint)
+        if self.restored and self.current_state != default_state:
+            LOGGER.warning("Checkpoint: {} overrides default state: {} with: {}".format(
+                checkpoint, default_state, self.current_state))
+        if not self.restored:
+            try:
+                self.load_state_enumeration()
+            except Exception:
+                LOGGER.warning("Cannot load state enumeration -- will use library instead")
+                self.summaryState_enum = states.state_enumeration
+        self.checkpoint = checkpoint
+
+    @property
+    def current_state(self):
+        return self._current_state
+
+    @current_state.setter
+    def current_state(self, state):
+        with self.checkpoint_lock:
+            self._current_state = state
+            if self.checkpoint:
+                self.save_checkpoint()
+
+    def save_checkpoint(self):
+        """
+        Write the current state, the applied settings and the last
+        payload of each event to the checkpoint file. Failures to write
+        are logged, they do not stop the transition or the event
+        """
+        with self.checkpoint_lock:
+            checkpoint = {'Device': self.Device,
+                          'current_state': self.current_state,
+                          'settings': getattr(self, 'settings', None),
+                          'summaryState_enum': self.summaryState_enum,
+                          'payloads': self.payloads}
+            # Write to a unique temporary file and rename, so a crash never
+            # leaves a truncated checkpoint behind
+            tmpfile = None
+            try:
+                fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.checkpoint)),
+                                               prefix=os.path.basename(self.checkpoint) + '.',
+                                               suffix='.tmp')
+                with os.fdopen(fd, 'w') as fp:
+                    json.dump(checkpoint, fp, default=json_value)
+                os.replace(tmpfile, self.checkpoint)
+            except Exception as err:
+                LOGGER.error("Cannot write checkpoint: {}: {}".format(self.checkpoint, err))
+                if tmpfile and os.path.exists(tmpfile):
+                    os.remove(tmpfile)
+
+    def load_checkpoint(self, checkpoint):
+        """
+        Restore the state from a checkpoint file. Returns true/false, a
+        checkpoint that cannot be used is logged and left untouched
+        """
         try:
-            self.load_state_enumeration()
+            with open(checkpoint) as fp:
+                saved = json.load(fp)
         except Exception:
-            LOGGER.warning("Cannot load state enumeration -- will use library instead")
-            self.summaryState_enum = states.state_enumeration
+            LOGGER.warning("Cannot read checkpoint: {} -- will start from scratch".format(checkpoint))
+            return False
+        if not isinstance(saved, dict) or saved.get('Device') != self.Device:
+            LOGGER.warning("Checkpoint: {} is not for {} -- ignoring it".format(checkpoint, self.Device))
+            return False
+        if saved.get('current_state') not in states.state_names:
+            LOGGER.warning("Checkpoint: {} has an unknown state: {} -- ignoring it".format(
+                checkpoint, saved.get('current_state')))
+            return False
+        if not isinstance(saved.get('summaryState_enum'), dict):
+            LOGGER.warning("Checkpoint: {} has no summaryState enumeration -- ignoring it".format(checkpoint))
+            return False
+        self.current_state = saved['current_state']
+        self.summaryState_enum = saved['summaryState_enum']
+        if saved.get('settings') is not None:
+            self.settings = saved['settings']
+        payloads = saved.get('payloads')
+        for eventname, payload in (payloads.items() if isinstance(payloads, dict) else []):
+            if eventname in self.myData and isinstance(payload, dict):
+                self.myData[eventname] = update_myData(self.myData[eventname], **payload)
+                self.payloads[eventname] = payload
+        LOGGER.info('Restored state: {} from checkpoint: {}'.format(self.current_state, checkpoint))
+        return True
 
     def load_state_enumeration(self):
         """
@@ -126,7 +247,9 @@ class DeviceState:
             LOGGER.info("name: {0:10s} -- number: {1:2d}".format(name, self.summaryState_enum[name]))
 
     def subscribe_list(self, eventlist):
-        # Subscribe to list of logEvents
+        # Subscribe to list of logEvents, all the events share one mgr
+        self.event_mgr = None
+        self.event_lock = threading.Lock()
         self.mgr = {}
         self.myData = {}
         self.logEvent = {}
@@ -158,10 +281,17 @@ class DeviceState:
             LOGGER.info('\t{}:{}'.format(key, getattr(self.myData[eventname], key)))
 
         LOGGER.info('Sending {}'.format(eventname))
-        self.logEvent[eventname](self.myData[eventname], priority)
+        with self.event_lock:
+            self.logEvent[eventname](self.myData[eventname], priority)
         LOGGER.info('Sent sucessfully {} Data Object'.format(eventname))
         for key in self.myData_keys[eventname]:
             LOGGER.info('\t{}:{}'.format(key, getattr(self.myData[eventname], key)))
+        # Keep the payload to be able to restore it after a restart
+        with self.checkpoint_lock:
+            self.payloads[eventname] = {key: plain_value(getattr(self.myData[eventname], key))
+                                        for key in self.myData_keys[eventname]}
+            if self.checkpoint:
+                self.save_checkpoint()
         time.sleep(self.tsleep)
         return True
 
@@ -170,11 +300,18 @@ class DeviceState:
         Create a subscription for the {Device}_logevent_{eventnname}
         This step need to be done before we call send_logEvent
         """
-        self.mgr[eventname] = getattr(self.SALPY_lib, 'SAL_{}'.format(self.Device))()
-        self.mgr[eventname].salEventPub("{}_logevent_{}".format(self.Device, eventname))
+        name = "{}_logevent_{}".format(self.Device, eventname)
+        # Attach to the event if it was pre-registered
+        handle = take_preloaded('logEvent', name)
+        if handle:
+            self.mgr[eventname], self.myData[eventname] = handle
+        else:
+            if self.event_mgr is None:
+                self.event_mgr = getattr(self.SALPY_lib, 'SAL_{}'.format(self.Device))()
+            self.mgr[eventname] = self.event_mgr
+            self.mgr[eventname].salEventPub(name)
+            self.myData[eventname] = getattr(self.SALPY_lib, name + 'C')()
         self.logEvent[eventname] = getattr(self.mgr[eventname], 'logEvent_{}'.format(eventname))
-        self.myData[eventname] = getattr(
-            self.SALPY_lib, '{}_logevent_{}C'.format(self.Device, eventname))()
 
         self.myData_keys[eventname] = [a[0] for a in inspect.getmembers(
             self.myData[eventname]) if not(a[0].startswith('__') and a[0].endswith('__'))]
@@ -184,6 +321,39 @@ class DeviceState:
         """Function to get the current state"""
         return self.current_state
 
+    def apply_transition(self, COMMAND, myData=None):
+        """
+        Move to the state reached by a (validated) transition COMMAND
+        and send the logEvents that go with it
+        """
+        # Update the current state
+        self.current_state = states.next_state[COMMAND]
+
+        if COMMAND == 'ENTERCONTROL':
+            self.send_logEvent("settingVersions", recommendedSettingsVersion='normal')
+            self.send_logEvent('summaryState')
+        elif COMMAND == 'START':
+            # TODO: use either 'myData.configure' or
+            # 'myData.settingsToApply'. The XML keeps changing
+            #
+            # Here we extract 'myData.configure' or
+            # 'myData.settingsToApply' for START, eventually we
+            # will apply the setting for this configuration.
+            try:
+                settings = myData.configure
+            except Exception:
+                settings = getattr(myData, 'settingsToApply', None)
+            LOGGER.info("From {} received configure: {}".format(COMMAND, settings))
+            # Here we should apply the setting in the future
+            if settings is not None:
+                self.settings = settings
+            self.send_logEvent('settingsApplied')
+            self.send_logEvent('appliedSettingsMatchStart',
+                               appliedSettingsMatchStartIsTrue=1)
+            self.send_logEvent('summaryState')
+        else:
+            self.send_logEvent('summaryState')
+
 
 class DDSController(threading.Thread):
 
@@ -229,9 +399,13 @@ class DDSController(threading.Thread):
 
         # Load (if not in globals already) SALPY_{deviceName} into class
         self.SALPY_lib = load_SALPYlib(self.Device)
-        self.mgr = getattr(self.SALPY_lib, 'SAL_{}'.format(self.Device))()
-        self.mgr.salProcessor(self.topic)
-        self.myData = getattr(self.SALPY_lib, self.topic+'C')()
+        handle = take_preloaded('Command', self.topic)
+        if handle:
+            self.mgr, self.myData = handle
+        else:
+            self.mgr = getattr(self.SALPY_lib, 'SAL_{}'.format(self.Device))()
+            self.mgr.salProcessor(self.topic)
+            self.myData = getattr(self.SALPY_lib, self.topic+'C')()
         LOGGER.info("{} controller ready for topic: {}".format(self.Device, self.topic))
 
         # We use getattr to get the equivalent of for our accept and ack command
@@ -259,32 +433,8 @@ class DDSController(threading.Thread):
             msg = "Successful transition from: {} --> {}".format(self.State.current_state,
                                                                  self.next_state)
             self.mgr_ackCommand(cmdId, self.SALPY_lib.SAL__CMD_COMPLETE, 0, msg)
-            # Update the current state
-            self.State.current_state = self.next_state
-
-            if self.COMMAND == 'ENTERCONTROL':
-                self.State.send_logEvent("settingVersions", recommendedSettingsVersion='normal')
-                self.State.send_logEvent('summaryState')
-            elif self.COMMAND == 'START':
-                # TODO: use either 'myData.configure' or
-                # 'myData.settingsToApply'. The XML keeps changing
-                #
-                # Here we extract 'myData.configure' or
-                # 'myData.settingsToApply' for START, eventually we
-                # will apply the setting for this configuration.
-                try:
-                    LOGGER.info("From {} received configure: {}".format(
-                        self.COMMAND, self.myData.configure))
-                except Exception:
-                    LOGGER.info("From {} received configure: {}".format(
-                        self.COMMAND, self.myData.settingsToApply))
-                # Here we should apply the setting in the future
-                self.State.send_logEvent('settingsApplied')
-                self.State.send_logEvent('appliedSettingsMatchStart',
-                                         appliedSettingsMatchStartIsTrue=1)
-                self.State.send_logEvent('summaryState')
-            else:
-                self.State.send_logEvent('summaryState')
+            # Update the current state and send the events
+            self.State.apply_transition(self.COMMAND, self.myData)
         else:
             msg = "WARNING: Invalid Transition from: {} --> {}".format(self.State.current_state,
                                                                        self.next_state)
@@ -307,11 +457,260 @@ def validate_transition(current_state, new_state):
     return transition_is_valid
 
 
+class CommandWorkerPool:
+
+    """
+    A bounded queue of accepted Commands executed by a pool of worker
+    threads. Jobs are grouped by key, and each key can have an optional
+    limit on how many of its jobs run at the same time; jobs over the
+    limit wait (in order) for a running job of the same key to finish.
+    The pool can be shared by several DDSCommandServer instances.
+    """
+
+    def __init__(self, nworkers=4, queue_size=100):
+        self.nworkers = nworkers
+        self.queue_size = queue_size
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        # Number of jobs accepted and not finished yet (queued, deferred or running)
+        self.npending = 0
+        self.running = {}
+        self.deferred = {}
+        self.workers = []
+        for k in range(nworkers):
+            worker = threading.Thread(target=self.run_worker, name='CommandWorker-{}'.format(k))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def reserve(self):
+        """
+        Reserve a slot in the queue for a job to be put() later. Returns
+        False when the pool is full
+        """
+        with self.lock:
+            if self.npending >= self.queue_size:
+                return False
+            self.npending += 1
+        return True
+
+    def put(self, key, job, limit=None):
+        """Queue a job (a callable with no arguments) in a reserved slot"""
+        self.queue.put((key, job, limit))
+
+    def submit(self, key, job, limit=None):
+        """
+        Queue a job (a callable with no arguments). Returns False
+        without queueing when the pool is full
+        """
+        if not self.reserve():
+            return False
+        self.put(key, job, limit=limit)
+        return True
+
+    def run_worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            key, job, limit = item
+            with self.lock:
+                if limit and self.running.get(key, 0) >= limit:
+                    self.deferred.setdefault(key, collections.deque()).append(job)
+                    continue
+                self.running[key] = self.running.get(key, 0) + 1
+            # Keep running the deferred jobs for this key, this way the
+            # number of running jobs for the key never goes over the limit
+            while job is not None:
+                try:
+                    job()
+                except Exception:
+                    LOGGER.exception("Command job for {} failed".format(key))
+                with self.lock:
+                    self.npending -= 1
+                    if self.deferred.get(key):
+                        job = self.deferred[key].popleft()
+                    else:
+                        self.running[key] -= 1
+                        job = None
+
+    def shutdown(self):
+        """Stop the workers once the queued jobs are done"""
+        for worker in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+
+
+class DDSCommandServer(threading.Thread):
+
+    """
+    Class to accept and reply to arbitrary Commands for a Device.
+    Command names are bound to handler callables with bind(). Accepted
+    commands are immediately acknowledged as SAL__CMD_INPROGRESS and
+    queued to a CommandWorkerPool, the final ack is sent from the
+    worker once the handler returns. When the queue is full the command
+    is rejected with SAL__CMD_NOPERM and a busy message.
+
+    A handler is called with the command myData and can return:
+    - None or a message string: acked as SAL__CMD_COMPLETE
+    - a tuple (ack, msg) with the ack code to send
+    The message is sent as str(msg). If the handler raises an exception
+    or returns any other kind of tuple, the command is acked as
+    SAL__CMD_FAILED.
+    """
+
+    def __init__(self, Device='atHeaderService', handlers=None, limits=None, nworkers=4, queue_size=100,
+                 pool=None, tsleep=0.1, threadID='1'):
+        threading.Thread.__init__(self)
+        self.threadID = threadID
+        self.Device = Device
+        self.tsleep = tsleep
+        self.daemon = True
+        if pool is None:
+            pool = CommandWorkerPool(nworkers=nworkers, queue_size=queue_size)
+        self.pool = pool
+        self.running = True
+
+        # Load (if not in globals already) SALPY_{deviceName} into class
+        self.SALPY_lib = load_SALPYlib(self.Device)
+        self.mgr = getattr(self.SALPY_lib, 'SAL_{}'.format(self.Device))()
+        # The mgr is shared between the accept loop and the workers
+        self.mgr_lock = threading.Lock()
+        self.handlers = {}
+        self.limits = {}
+        self.groups = {}
+        self.myData = {}
+        self.mgr_acceptCommand = {}
+        self.mgr_ackCommand = {}
+
+        if not limits:
+            limits = {}
+        if handlers:
+            for command, handler in handlers.items():
+                self.bind(command, handler, limit=limits.get(command))
+
+    def bind(self, command, handler, limit=None, group=None):
+        """
+        Bind a command name to a handler. Commands that share a group
+        also share the concurrency limit of the group
+        """
+        if group is None:
+            group = command
+        if command not in self.mgr_acceptCommand:
+            topic = "{}_command_{}".format(self.Device, command)
+            with self.mgr_lock:
+                self.mgr.salProcessor(topic)
+                self.mgr_acceptCommand[command] = getattr(self.mgr, 'acceptCommand_{}'.format(command))
+                self.mgr_ackCommand[command] = getattr(self.mgr, 'ackCommand_{}'.format(command))
+            self.myData[command] = getattr(self.SALPY_lib, topic + 'C')()
+            LOGGER.info("{} command server ready for topic: {}".format(self.Device, topic))
+        self.handlers[command] = handler
+        self.groups[command] = group
+        if limit is not None:
+            self.limits[group] = limit
+
+    def bind_transitions(self, State, commands=states.transition_commands):
+        """
+        Bind the lifecycle transition commands to update State. The
+        transitions are run one at a time
+        """
+        for command in commands:
+            self.bind(command, self.transition_handler(State, command), limit=1, group='transition')
+
+    def transition_handler(self, State, command):
+        """Make a handler that moves State through a transition command"""
+        COMMAND = command.upper()
+        next_state = states.next_state[COMMAND]
+
+        def handler(myData):
+            if not validate_transition(State.current_state, next_state):
+                msg = "WARNING: Invalid Transition from: {} --> {}".format(State.current_state, next_state)
+                LOGGER.warning(msg)
+                return (self.SALPY_lib.SAL__CMD_NOPERM, msg)
+            msg = "Successful transition from: {} --> {}".format(State.current_state, next_state)
+            State.apply_transition(COMMAND, myData)
+            return msg
+        return handler
+
+    def ackCommand(self, command, cmdId, ack, msg):
+        with self.mgr_lock:
+            self.mgr_ackCommand[command](cmdId, ack, 0, msg)
+
+    def run(self):
+        """ The run method for the threading"""
+        while self.running:
+            self.poll()
+            time.sleep(self.tsleep)
+
+    def poll(self):
+        """Accept all the waiting commands and queue them. Returns the number accepted"""
+        naccepted = 0
+        for command in list(self.handlers):
+            while True:
+                with self.mgr_lock:
+                    cmdId = self.mgr_acceptCommand[command](self.myData[command])
+                if cmdId <= 0:
+                    break
+                naccepted += 1
+                # Hand over myData to the job and get a fresh one for the next accept
+                myData = self.myData[command]
+                self.myData[command] = getattr(
+                    self.SALPY_lib, '{}_command_{}C'.format(self.Device, command))()
+                group = self.groups[command]
+                job = functools.partial(self.execute, command, cmdId, myData)
+                # Send INPROGRESS before the job is queued, so it cannot
+                # arrive after the final ack sent by the worker
+                if self.pool.reserve():
+                    self.ackCommand(command, cmdId, self.SALPY_lib.SAL__CMD_INPROGRESS, "In progress")
+                    self.pool.put((id(self), group), job, limit=self.limits.get(group))
+                else:
+                    msg = "Busy: cannot queue {} cmdId: {}".format(command, cmdId)
+                    LOGGER.warning(msg)
+                    self.ackCommand(command, cmdId, self.SALPY_lib.SAL__CMD_NOPERM, msg)
+        return naccepted
+
+    def execute(self, command, cmdId, myData):
+        """Run the handler for a command and send the final ack"""
+        try:
+            reply = self.handlers[command](myData)
+        except Exception as err:
+            LOGGER.exception("Handler for {} cmdId: {} failed".format(command, cmdId))
+            reply = (self.SALPY_lib.SAL__CMD_FAILED, "Failed: {}".format(err))
+        if isinstance(reply, tuple):
+            if len(reply) == 2 and isinstance(reply[0], int):
+                ack, msg = reply
+            else:
+                LOGGER.error("Handler for {} cmdId: {} returned: {!r}".format(command, cmdId, reply))
+                ack, msg = (self.SALPY_lib.SAL__CMD_FAILED, "Failed: malformed reply {!r}".format(reply))
+        else:
+            ack = self.SALPY_lib.SAL__CMD_COMPLETE
+            msg = reply if reply else "Done : OK"
+        try:
+            self.ackCommand(command, cmdId, ack, str(msg))
+        except Exception as err:
+            # Make sure the command still gets a final ack
+            LOGGER.exception("Cannot ack {} cmdId: {} with: {}".format(command, cmdId, ack))
+            self.ackCommand(command, cmdId, self.SALPY_lib.SAL__CMD_FAILED, "Failed: {}".format(err))
+
+    def stop(self):
+        """Stop accepting commands"""
+        self.running = False
+
+
 class DDSSubscriber(threading.Thread):
 
-    """ Class to Subscribe to Telemetry, it could a Command (discouraged), Event or Telemetry"""
+    """
+    Class to Subscribe to Telemetry, it could a Command (discouraged), Event or Telemetry.
+    Running statistics (see salpytools.stats.FieldStats) of numeric fields
+    are kept for the list of field names in stats, with stats_keys passed
+    to FieldStats (i.e. window for tumbling windows).
+    If callback is set, it is called with myData for every new sample,
+    from the subscriber thread
+    """
 
-    def __init__(self, Device, topic, threadID='1', Stype='Telemetry', tsleep=0.01, timeout=3600, nkeep=100):
+    def __init__(self, Device, topic, threadID='1', Stype='Telemetry', tsleep=0.01, timeout=3600, nkeep=100,
+                 stats=None, stats_keys=None, callback=None):
         threading.Thread.__init__(self)
         self.threadID = threadID
         self.Device = Device
@@ -321,6 +720,11 @@ class DDSSubscriber(threading.Thread):
         self.timeout = timeout
         self.nkeep = nkeep
         self.daemon = True
+        self.callback = callback
+        self.stats = {}
+        if stats:
+            for field in stats:
+                self.stats[field] = FieldStats(**(stats_keys or {}))
         self.subscribe()
 
     def subscribe(self):
@@ -337,30 +741,40 @@ class DDSSubscriber(threading.Thread):
 
         # Load (if not in globals already) SALPY_{deviceName} into class
         self.SALPY_lib = load_SALPYlib(self.Device)
-        self.mgr = getattr(self.SALPY_lib, 'SAL_{}'.format(self.Device))()
+        if self.Stype == 'Telemetry':
+            name = "{}_{}".format(self.Device, self.topic)
+        elif self.Stype == 'Event':
+            name = "{}_logevent_{}".format(self.Device, self.topic)
+        elif self.Stype == 'Command':
+            name = "{}_command_{}".format(self.Device, self.topic)
+        else:
+            raise ValueError("Stype=%s not defined\n" % self.Stype)
+
+        # Attach to the topic if it was pre-registered
+        handle = take_preloaded(self.Stype, name)
+        if handle:
+            self.mgr, self.myData = handle
+        else:
+            self.mgr = getattr(self.SALPY_lib, 'SAL_{}'.format(self.Device))()
+            self.myData = getattr(self.SALPY_lib, name + 'C')()
 
         if self.Stype == 'Telemetry':
-            self.myData = getattr(self.SALPY_lib, '{}_{}C'.format(self.Device, self.topic))()
-            self.mgr.salTelemetrySub("{}_{}".format(self.Device, self.topic))
+            if not handle:
+                self.mgr.salTelemetrySub(name)
             # Generic method to get for example: self.mgr.getNextSample_kernel_FK5Target
             self.getNextSample = getattr(self.mgr, "getNextSample_{}".format(self.topic))
-            LOGGER.info("{} subscriber ready for Device:{} topic:{}".format(
-                self.Stype, self.Device, self.topic))
         elif self.Stype == 'Event':
-            self.myData = getattr(
-                self.SALPY_lib, '{}_logevent_{}C'.format(self.Device, self.topic))()
-            self.mgr.salEventSub("{}_logevent_{}".format(self.Device, self.topic))
+            if not handle:
+                self.mgr.salEventSub(name)
             # Generic method to get for example: self.mgr.getEvent_startIntegration(event)
             self.getEvent = getattr(self.mgr, 'getEvent_{}'.format(self.topic))
-            LOGGER.info("{} subscriber ready for Device:{} topic:{}".format(
-                self.Stype, self.Device, self.topic))
         elif self.Stype == 'Command':
-            self.myData = getattr(self.SALPY_lib, '{}_command_{}C'.format(self.Device, self.topic))()
-            self.mgr.salProcessor("{}_command_{}".format(self.Device, self.topic))
+            if not handle:
+                self.mgr.salProcessor(name)
             # Generic method to get for example: self.mgr.acceptCommand_takeImages(event)
             self.acceptCommand = getattr(self.mgr, 'acceptCommand_{}'.format(self.topic))
-            LOGGER.info("{} subscriber ready for Device:{} topic:{}".format(
-                self.Stype, self.Device, self.topic))
+        LOGGER.info("{} subscriber ready for Device:{} topic:{}".format(
+            self.Stype, self.Device, self.topic))
 
     def run(self):
         """ The run method for the threading"""
@@ -384,6 +798,10 @@ class DDSSubscriber(threading.Thread):
                 self.myDatalist.append(self.myData)
                 self.myDatalist = self.myDatalist[-self.nkeep:]  # Keep only nkeep entries
                 self.newTelem = True
+                if self.stats:
+                    self.update_stats()
+                if self.callback:
+                    self.callback(self.myData)
             time.sleep(self.tsleep)
         return
 
@@ -395,6 +813,10 @@ class DDSSubscriber(threading.Thread):
                 self.myDatalist.append(self.myData)
                 self.myDatalist = self.myDatalist[-self.nkeep:]  # Keep only nkeep entries
                 self.newEvent = True
+                if self.stats:
+                    self.update_stats()
+                if self.callback:
+                    self.callback(self.myData)
                 # Capture the current timeStamp only if defined as an attribute!
                 if hasattr(self.myData, 'timeStamp'):
                     self.timeStamp = self.myData.timeStamp
@@ -425,6 +847,18 @@ class DDSSubscriber(threading.Thread):
             LOGGER.warning(msg)
         return Current
 
+    def update_stats(self):
+        """ Add the fields of the current sample to their running stats"""
+        t = time.time()
+        for field, stats in self.stats.items():
+            value = getattr(self.myData, field, None)
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                stats.add(value, t)
+
+    def getStats(self, field):
+        """ Dictionary with the running stats of a field"""
+        return self.stats[field].summary()
+
     def getCurrentTelemetry(self):
         return self.getCurrent()
 
@@ -514,8 +948,9 @@ class DDSSend(threading.Thread):
     """
     Class to generate/send Telemetry, Events or Commands.
     In the case of a command, the class instance cannot be
-    re-used.
+    re-used (see DDSCommandClient for that).
     For Events/Telemetry, the same object can be re-used for a given Device,
+    and the publisher of each topic is registered only once.
     """
 
     def __init__(self, Device, sleeptime=1, timeout=5, threadID=1):
@@ -528,6 +963,8 @@ class DDSSend(threading.Thread):
         LOGGER.info("Loading Device: {}".format(self.Device))
         # Load SALPY_lib into the class
         self.SALPY_lib = load_SALPYlib(self.Device)
+        # Event/Telemetry publishers, keyed by topic name
+        self.publishers = {}
 
     def run(self):
         """ Function for threading"""
@@ -616,11 +1053,13 @@ class DDSSend(threading.Thread):
         myData = update_myData(myData, **kwargs)
         # Make it visible outside
         self.myData = myData
-        # Get the logEvent object to send myData
-        mgr = self.get_mgr()
-        # name = "{}_logevent_{}".format(self.Device, event)
-        mgr.salEventPub("{}_logevent_{}".format(self.Device, event))
-        logEvent = getattr(mgr, 'logEvent_{}'.format(event))
+        # Get the logEvent object to send myData, the publisher is registered only once
+        name = "{}_logevent_{}".format(self.Device, event)
+        if name not in self.publishers:
+            mgr = self.get_mgr()
+            mgr.salEventPub(name)
+            self.publishers[name] = getattr(mgr, 'logEvent_{}'.format(event))
+        logEvent = self.publishers[name]
         LOGGER.info("Sending Event: {}".format(event))
         logEvent(myData, priority)
         LOGGER.info("Done: {}".format(event))
@@ -636,10 +1075,13 @@ class DDSSend(threading.Thread):
         myData = update_myData(myData, **kwargs)
         # Make it visible outside
         self.myData = myData
-        # Get the Telemetry object to send myData
-        mgr = self.get_mgr()
-        mgr.salTelemetryPub("{}_{}".format(self.Device, topic))
-        putSample = getattr(mgr, 'putSample_{}'.format(topic))
+        # Get the Telemetry object to send myData, the publisher is registered only once
+        name = "{}_{}".format(self.Device, topic)
+        if name not in self.publishers:
+            mgr = self.get_mgr()
+            mgr.salTelemetryPub(name)
+            self.publishers[name] = getattr(mgr, 'putSample_{}'.format(topic))
+        putSample = self.publishers[name]
         LOGGER.info("Sending Telemetry: {}".format(topic))
         putSample(myData)
         LOGGER.info("Done: {}".format(topic))
@@ -655,6 +1097,167 @@ class DDSSend(threading.Thread):
         return myData_dic
 
 
+class DDSCommandClient(threading.Thread):
+
+    """
+    Re-usable client to issue Commands to a Device.
+    Unlike DDSSend.send_Command, the command publishers are registered
+    only once per command name and many commands (of any name) can be
+    in flight at the same time. Each call to issue() returns a
+    concurrent.futures.Future that resolves to the tuple (ack, msg)
+    with the final ack code and result message. Completions are
+    collected by a single thread that polls the ack topics for all
+    in-flight commands, instead of a blocking waitForCompletion per
+    command. Commands that are not completed after their timeout
+    resolve to (SAL__CMD_NOACK, msg), the same code returned by
+    waitForCompletion. The polling thread is started by the first
+    issue(), if start() was not called before.
+    """
+
+    def __init__(self, Device, timeout=5, tsleep=0.01, threadID=1):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.threadID = threadID
+        self.Device = Device
+        self.timeout = timeout
+        self.tsleep = tsleep
+        LOGGER.info("Loading Device: {}".format(self.Device))
+        # Load SALPY_lib into the class and get a single mgr for all commands
+        self.SALPY_lib = load_SALPYlib(self.Device)
+        self.mgr = getattr(self.SALPY_lib, 'SAL_{}'.format(self.Device))()
+        # The mgr is shared between the callers of issue() and the polling thread
+        self.mgr_lock = threading.Lock()
+        self.issueCommand = {}
+        self.getResponse = {}
+        self.ackData = getattr(self.SALPY_lib, '{}_ackcmdC'.format(self.Device))()
+        # Final ack codes, anything else (ACK, INPROGRESS, STALLED) is intermediate
+        self.final_acks = [getattr(self.SALPY_lib, 'SAL__CMD_{}'.format(name)) for name in
+                           ['COMPLETE', 'NOPERM', 'NOACK', 'FAILED', 'ABORTED', 'TIMEOUT']
+                           if hasattr(self.SALPY_lib, 'SAL__CMD_{}'.format(name))]
+        # In-flight commands, keyed by cmd name and then cmdId
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self.running = True
+        self.start_lock = threading.Lock()
+        self.poller_started = False
+
+    def start(self):
+        """Start the polling thread, only once"""
+        with self.start_lock:
+            if self.poller_started:
+                return
+            self.poller_started = True
+        threading.Thread.start(self)
+
+    def register(self, cmd):
+        """
+        Register the publisher for a command. This is done on the fly by
+        issue(), but can be called ahead of time to avoid the latency on
+        the first command
+        """
+        if cmd in self.issueCommand:
+            return
+        # The pending entry must exist before the poller can see getResponse[cmd]
+        with self.pending_lock:
+            self.pending.setdefault(cmd, {})
+        with self.mgr_lock:
+            if cmd in self.issueCommand:
+                return
+            self.mgr.salProcessor("{}_command_{}".format(self.Device, cmd))
+            self.getResponse[cmd] = getattr(self.mgr, 'getResponse_{}'.format(cmd))
+            self.issueCommand[cmd] = getattr(self.mgr, 'issueCommand_{}'.format(cmd))
+        LOGGER.info("{} command client ready for: {}".format(self.Device, cmd))
+
+    def issue(self, cmd, **kwargs):
+        """
+        Issue a Command to a Device and return a Future for its completion.
+        Use the keyword timeout to override the default timeout (sec)
+        """
+        timeout = kwargs.pop('timeout', self.timeout)
+        # Without the poller the futures would never resolve, not even on timeout
+        self.start()
+        self.register(cmd)
+        myData = getattr(self.SALPY_lib, '{}_command_{}C'.format(self.Device, cmd))()
+        myData = update_myData(myData, **kwargs)
+        future = concurrent.futures.Future()
+        # Hold the pending lock so the poller cannot see the ack before we
+        # know about the cmdId
+        with self.pending_lock:
+            with self.mgr_lock:
+                cmdId = self.issueCommand[cmd](myData)
+            if cmdId <= 0:
+                future.set_result((cmdId, "Could not issue command: {}".format(cmd)))
+                return future
+            future.cmd = cmd
+            future.cmdId = cmdId
+            self.pending[cmd][cmdId] = (future, time.time() + timeout)
+        LOGGER.debug("Issued command: {} cmdId: {}".format(cmd, cmdId))
+        return future
+
+    def cancel(self, future):
+        """Stop waiting for the completion of a Command"""
+        return future.cancel()
+
+    def in_flight(self):
+        """Number of Commands waiting for completion"""
+        with self.pending_lock:
+            return sum(len(p) for p in self.pending.values())
+
+    def run(self):
+        """ The run method for the threading"""
+        while self.running:
+            # A bad ack must not stop the completions of all the other Commands
+            try:
+                self.poll()
+            except Exception as err:
+                LOGGER.error("{} command client poll failed: {}".format(self.Device, err))
+            time.sleep(self.tsleep)
+
+    def poll(self):
+        """Collect all available acks and expire timed out Commands"""
+        now = time.time()
+        for cmd in list(self.getResponse):
+            with self.pending_lock:
+                if not self.pending.get(cmd):
+                    continue
+            while True:
+                with self.mgr_lock:
+                    cmdId = self.getResponse[cmd](self.ackData)
+                    ack = self.ackData.ack
+                    msg = self.ackData.result
+                if cmdId <= 0:
+                    break
+                if ack not in self.final_acks:
+                    continue
+                with self.pending_lock:
+                    entry = self.pending.get(cmd, {}).pop(cmdId, None)
+                if entry is not None and entry[0].set_running_or_notify_cancel():
+                    entry[0].set_result((ack, msg))
+            with self.pending_lock:
+                for cmdId, (future, deadline) in list(self.pending.get(cmd, {}).items()):
+                    if future.cancelled():
+                        del self.pending[cmd][cmdId]
+                    elif now > deadline:
+                        del self.pending[cmd][cmdId]
+                        LOGGER.warning("Command: {} cmdId: {} timed out".format(cmd, cmdId))
+                        if future.set_running_or_notify_cancel():
+                            future.set_result((self.SALPY_lib.SAL__CMD_NOACK,
+                                               "Timeout waiting for: {}".format(cmd)))
+
+    def shutdown(self):
+        """Stop the polling thread, cancel all pending Commands and shutdown the mgr"""
+        self.running = False
+        if self.is_alive():
+            self.join()
+        with self.pending_lock:
+            for cmd in self.pending:
+                for future, deadline in self.pending[cmd].values():
+                    future.cancel()
+                self.pending[cmd] = {}
+        with self.mgr_lock:
+            self.mgr.salShutdown()
+
+
 def update_myData(myData, **kwargs):
     """ Updating myData with kwargs """
     myData_keys = [a[0] for a in inspect.getmembers(myData) if not(
@@ -667,6 +1270,91 @@ def update_myData(myData, **kwargs):
     return myData
 
 
+def get_myData_keys(myData):
+    """ Get the list of keys (public members) of a myData C object"""
+    return [a[0] for a in inspect.getmembers(myData) if not(
+        a[0].startswith('__') and a[0].endswith('__'))]
+
+
+def plain_value(value):
+    """Convert SWIG arrays and other non-picklable values into plain python"""
+    if isinstance(value, (int, float, str, bytes, bool)) or value is None:
+        return value
+    try:
+        return list(value)
+    except TypeError:
+        return str(value)
+
+
+def json_value(value):
+    """Convert the values json cannot serialize (i.e. bytes) into plain strings"""
+    if isinstance(value, bytes):
+        return value.decode('utf-8', errors='replace')
+    return str(value)
+
+
+def subscribe_topic(SALPY_lib, mgr, Device, topic, Stype='Telemetry'):
+    """
+    Subscribe a mgr to a Telemetry/Event/Command topic of a Device, the
+    same way DDSSubscriber does it. Returns the tuple (myData, getSample)
+    where getSample(myData) copies the next sample into myData and
+    returns 0, or returns a non-zero value if there is nothing new
+    """
+    if Stype == 'Telemetry':
+        myData = getattr(SALPY_lib, '{}_{}C'.format(Device, topic))()
+        mgr.salTelemetrySub("{}_{}".format(Device, topic))
+        getSample = getattr(mgr, "getNextSample_{}".format(topic))
+    elif Stype == 'Event':
+        myData = getattr(SALPY_lib, '{}_logevent_{}C'.format(Device, topic))()
+        mgr.salEventSub("{}_logevent_{}".format(Device, topic))
+        getSample = getattr(mgr, 'getEvent_{}'.format(topic))
+    elif Stype == 'Command':
+        myData = getattr(SALPY_lib, '{}_command_{}C'.format(Device, topic))()
+        mgr.salProcessor("{}_command_{}".format(Device, topic))
+        acceptCommand = getattr(mgr, 'acceptCommand_{}'.format(topic))
+
+        # acceptCommand returns the cmdId (> 0) for a new command
+        def getSample(myData):
+            return 0 if acceptCommand(myData) > 0 else -1
+    else:
+        raise ValueError("Stype=%s not defined\n" % Stype)
+    LOGGER.info("{} subscriber ready for Device:{} topic:{}".format(Stype, Device, topic))
+    return myData, getSample
+
+
+def subscribe_topics(topics):
+    """
+    Subscribe to a list of (Device, topic, Stype) with one mgr per
+    Device for all its topics. Returns the tuple (mgr, readers), with
+    mgr a dictionary keyed by Device and readers the list of (Device,
+    topic, myData, getSample, keys) in the order of topics
+    """
+    mgr = {}
+    readers = []
+    for Device, topic, Stype in topics:
+        SALPY_lib = load_SALPYlib(Device)
+        if Device not in mgr:
+            mgr[Device] = getattr(SALPY_lib, 'SAL_{}'.format(Device))()
+        myData, getSample = subscribe_topic(SALPY_lib, mgr[Device], Device, topic, Stype)
+        readers.append((Device, topic, myData, getSample, get_myData_keys(myData)))
+    return mgr, readers
+
+
+def time_key(keys):
+    """The first of time_keys found in keys, None if there is none"""
+    for key in time_keys:
+        if key in keys:
+            return key
+    return None
+
+
+def mgr_time(mgr=None):
+    """The current time from a SAL mgr (TAI, as private_sndStamp), time.time() if there is no mgr"""
+    if mgr is None:
+        return time.time()
+    return mgr.getCurrentTime()
+
+
 def command_sequencer(commands, Device='ATHeaderService', wait_time=1, sleep_time=3):
     """
     Stand-alone function to send a sequence of OCS Commands
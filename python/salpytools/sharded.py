@@ -0,0 +1,330 @@
+# This file is part of salpytools
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import time
+import types
+import struct
+import queue
+import pickle
+import logging
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
+from salpytools import salpylib
+
+"""
+Sharded subscriptions for Devices with many high-rate topics. The
+topics are spread across N worker processes, each one with its own
+SALPY_lib and mgr, so the unpacking of the samples is not bound to a
+single core by the GIL. The workers push the decoded samples to the
+parent through a shared-memory ring per worker, and the parent
+presents them through the DDSSubscriber API.
+
+- DDSShardedSubscriber: Start the workers and collect the samples
+  (threaded)
+- DDSShardTopic: DDSSubscriber fed by DDSShardedSubscriber
+- ShmRing: single-producer/single-consumer ring of byte records in
+  shared memory
+"""
+
+LOGGER = logging.getLogger(__name__)
+
+
+class ShmRing:
+
+    """
+    A single-producer/single-consumer ring of fixed size slots in
+    shared memory. Each slot holds one record of up to slot_size-4
+    bytes. The header stores the write (head) and read (tail) counters
+    and the number of records dropped because the ring was full; the
+    producer only writes head/dropped and the consumer only writes tail.
+    """
+
+    header = struct.Struct('<QQQ')
+    header_size = 64
+    length = struct.Struct('<I')
+
+    def __init__(self, name=None, create=False, nslots=4096, slot_size=4096):
+        self.nslots = nslots
+        self.slot_size = slot_size
+        size = self.header_size + nslots * slot_size
+        self.shm = shared_memory.SharedMemory(name=name, create=create, size=size)
+        self.name = self.shm.name
+        self.buf = self.shm.buf
+        if create:
+            self.header.pack_into(self.buf, 0, 0, 0, 0)
+
+    def counters(self):
+        """Return the tuple (head, tail, dropped)"""
+        return self.header.unpack_from(self.buf, 0)
+
+    def put(self, record):
+        """Add a record, returns False if it was dropped"""
+        head, tail, dropped = self.header.unpack_from(self.buf, 0)
+        if head - tail >= self.nslots or len(record) > self.slot_size - self.length.size:
+            struct.pack_into('<Q', self.buf, 16, dropped + 1)
+            return False
+        offset = self.header_size + (head % self.nslots) * self.slot_size
+        self.length.pack_into(self.buf, offset, len(record))
+        start = offset + self.length.size
+        self.buf[start:start + len(record)] = record
+        # Publish the record only once it has been written
+        struct.pack_into('<Q', self.buf, 0, head + 1)
+        return True
+
+    def get(self):
+        """Get the next record, or None if the ring is empty"""
+        head, tail, dropped = self.header.unpack_from(self.buf, 0)
+        if tail == head:
+            return None
+        offset = self.header_size + (tail % self.nslots) * self.slot_size
+        nbytes, = self.length.unpack_from(self.buf, offset)
+        start = offset + self.length.size
+        record = bytes(self.buf[start:start + nbytes])
+        struct.pack_into('<Q', self.buf, 8, tail + 1)
+        return record
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+
+def run_shard(topics, ring_name, nslots, slot_size, stop_event, keys_queue, tsleep=0.01):
+    """
+    The main loop of a worker process. Subscribe to a list of
+    (index, Device, topic, Stype) with one mgr per Device, send the
+    names of the fields of each topic as (index, keys) through
+    keys_queue (which never drops) and push to the ring a record
+    (index, rcv_time, values) for every sample
+    """
+    ring = ShmRing(name=ring_name, nslots=nslots, slot_size=slot_size)
+    mgr, subscribed = salpylib.subscribe_topics([topic[1:] for topic in topics])
+    readers = []
+    for (index, Device, topic, Stype), reader in zip(topics, subscribed):
+        myData, getSample, keys = reader[2:]
+        readers.append((index, myData, getSample, keys))
+        keys_queue.put((index, keys))
+
+    while not stop_event.is_set():
+        nsamples = 0
+        for index, myData, getSample, keys in readers:
+            while getSample(myData) == 0:
+                values = [salpylib.plain_value(getattr(myData, key)) for key in keys]
+                ring.put(pickle.dumps((index, time.time(), values), protocol=pickle.HIGHEST_PROTOCOL))
+                nsamples += 1
+        if nsamples == 0:
+            time.sleep(tsleep)
+
+    for Device in mgr:
+        mgr[Device].salShutdown()
+    ring.close()
+
+
+def per_topic(value, Device, topic):
+    """The value for a topic, if value is a dictionary keyed by (Device, topic)"""
+    if isinstance(value, dict) and all(isinstance(key, tuple) for key in value):
+        return value.get((Device, topic))
+    return value
+
+
+class DDSShardTopic(salpylib.DDSSubscriber):
+
+    """
+    A DDSSubscriber for one topic of a DDSShardedSubscriber. It does not
+    subscribe to DDS or run a thread, the samples are pushed by the
+    parent DDSShardedSubscriber as SimpleNamespace objects with the same
+    attributes as the myData C objects, plus rcv_time: the time the
+    sample was read by the worker process.
+    """
+
+    def subscribe(self):
+        self.newTelem = False
+        self.newEvent = False
+        self.newCommand = False
+        self.myData = None
+        self.myDatalist = []
+        self.keys = None
+        self.nreceived = 0
+
+    def run(self):
+        """ Samples are pushed by DDSShardedSubscriber, nothing to run"""
+        return
+
+    def push(self, values, rcv_time=None):
+        self.myData = types.SimpleNamespace(**dict(zip(self.keys, values)))
+        self.myData.rcv_time = rcv_time
+        self.myDatalist.append(self.myData)
+        self.myDatalist = self.myDatalist[-self.nkeep:]  # Keep only nkeep entries
+        self.nreceived += 1
+        if self.stats:
+            self.update_stats()
+        if self.callback:
+            self.callback(self.myData)
+        if self.Stype == 'Telemetry':
+            self.newTelem = True
+        elif self.Stype == 'Event':
+            self.newEvent = True
+            # Capture the current timeStamp only if defined as an attribute!
+            if hasattr(self.myData, 'timeStamp'):
+                self.timeStamp = self.myData.timeStamp
+        else:
+            self.newCommand = True
+
+
+class DDSShardedSubscriber(threading.Thread):
+
+    """
+    Subscribe to many topics for one or more Devices using nshards
+    worker processes. The topics are given as a list of (Device, topic,
+    Stype) and spread round-robin across the workers. The samples are
+    available through the DDSShardTopic returned by get(Device, topic),
+    which has the same API as DDSSubscriber (getCurrent, myDatalist,
+    waitEvent, getStats, etc.). stats, stats_keys and callback are
+    passed to every DDSSubscriber, or to one topic if given as a
+    dictionary keyed by (Device, topic). The callbacks are called from
+    the thread that collects the samples.
+    """
+
+    def __init__(self, topics, nshards=None, threadID='1', tsleep=0.01, timeout=3600, nkeep=100,
+                 nslots=4096, slot_size=4096, start_method='spawn', keys_timeout=10,
+                 stats=None, stats_keys=None, callback=None):
+        threading.Thread.__init__(self)
+        self.threadID = threadID
+        self.daemon = True
+        self.tsleep = tsleep
+        self.keys_timeout = keys_timeout
+        if not nshards:
+            nshards = os.cpu_count()
+        self.nshards = min(nshards, len(topics))
+        self.running = True
+
+        self.topics = []
+        self.subscribers = {}
+        for index, (Device, topic, Stype) in enumerate(topics):
+            self.topics.append((Device, topic, Stype))
+            self.subscribers[Device, topic] = DDSShardTopic(Device, topic, Stype=Stype, tsleep=tsleep,
+                                                            timeout=timeout, nkeep=nkeep,
+                                                            stats=per_topic(stats, Device, topic),
+                                                            stats_keys=per_topic(stats_keys, Device, topic),
+                                                            callback=per_topic(callback, Device, topic))
+
+        context = multiprocessing.get_context(start_method)
+        self.stop_event = context.Event()
+        # The field names go outside the rings, as the rings can drop records
+        self.keys_queue = context.Queue()
+        # Samples waiting for the field names of their topic, by index
+        self.backlog = {}
+        self.rings = []
+        self.workers = []
+        for shard in range(self.nshards):
+            shard_topics = [(index,) + self.topics[index]
+                            for index in range(shard, len(self.topics), self.nshards)]
+            ring = ShmRing(create=True, nslots=nslots, slot_size=slot_size)
+            worker = context.Process(target=run_shard, name='DDSShard-{}'.format(shard),
+                                     args=(shard_topics, ring.name, nslots, slot_size,
+                                           self.stop_event, self.keys_queue, tsleep))
+            worker.daemon = True
+            self.rings.append(ring)
+            self.workers.append(worker)
+            LOGGER.info("Shard {} will subscribe to {} topics".format(shard, len(shard_topics)))
+
+    def start(self):
+        """Start the worker processes and the thread that collects the samples"""
+        for worker in self.workers:
+            worker.start()
+        super().start()
+
+    def run(self):
+        """ The run method for the threading"""
+        while self.running:
+            if self.drain() == 0:
+                time.sleep(self.tsleep)
+
+    def drain(self):
+        """Collect all the records waiting in the rings. Returns the number of samples"""
+        self.drain_keys()
+        nsamples = 0
+        for ring in self.rings:
+            while True:
+                record = ring.get()
+                if record is None:
+                    break
+                index, rcv_time, values = pickle.loads(record)
+                subscriber = self.subscribers[self.topics[index][:2]]
+                if subscriber.keys is None:
+                    # The worker queues the keys before any sample of the
+                    # topic, but the queue delivers them asynchronously
+                    self.drain_keys(wait_index=index)
+                if subscriber.keys is None:
+                    # Keep the sample until the keys arrive
+                    self.backlog.setdefault(index, []).append((values, rcv_time))
+                    continue
+                subscriber.push(values, rcv_time=rcv_time)
+                nsamples += 1
+        return nsamples
+
+    def drain_keys(self, wait_index=None):
+        """
+        Collect the field names sent by the workers. If wait_index is
+        set, wait up to keys_timeout sec for the keys of that topic
+        """
+        deadline = time.time() + self.keys_timeout
+        while True:
+            waiting = wait_index is not None and self.subscribers[self.topics[wait_index][:2]].keys is None
+            try:
+                if waiting:
+                    index, keys = self.keys_queue.get(timeout=max(deadline - time.time(), 0))
+                else:
+                    index, keys = self.keys_queue.get_nowait()
+            except queue.Empty:
+                if waiting:
+                    LOGGER.error("No field names for {} after {} sec, holding its samples".format(
+                        self.topics[wait_index][:2], self.keys_timeout))
+                break
+            subscriber = self.subscribers[self.topics[index][:2]]
+            subscriber.keys = keys
+            for values, rcv_time in self.backlog.pop(index, []):
+                subscriber.push(values, rcv_time=rcv_time)
+
+    def get(self, Device, topic):
+        """Get the DDSShardTopic for a topic"""
+        return self.subscribers[Device, topic]
+
+    def dropped(self):
+        """Total number of samples dropped because the rings were full"""
+        return sum(ring.counters()[2] for ring in self.rings)
+
+    def shutdown(self):
+        """Stop the workers and release the shared memory"""
+        self.stop_event.set()
+        for worker in self.workers:
+            worker.join()
+        self.running = False
+        if self.is_alive():
+            self.join()
+        self.drain()
+        for ring in self.rings:
+            ring.close()
+            ring.unlink()
@@ -0,0 +1,189 @@
+# This file is part of salpytools
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import time
+import bisect
+import logging
+import threading
+from salpytools import salpylib
+
+"""
+Consistent multi-topic snapshots, for example to build a FITS header
+at the end of a readout with the values of many topics as of the same
+instant.
+
+- SnapshotRecorder: Subscribe to a set of topics and buffer their
+  history (threaded)
+- TopicHistory: Column store with the recent history of one topic
+
+The samples of each topic are kept by column (one list per field plus
+one for the sample times), so a snapshot does a single bisect per topic
+and then picks the fields, all under the same lock so no sample can
+arrive in the middle of a snapshot.
+"""
+
+LOGGER = logging.getLogger(__name__)
+
+class TopicHistory:
+
+    """ The last nkeep samples of a topic, stored by column and sorted by time"""
+
+    def __init__(self, keys, nkeep=1000):
+        self.keys = list(keys)
+        self.nkeep = nkeep
+        self.times = []
+        self.columns = {key: [] for key in self.keys}
+
+    def __len__(self):
+        return len(self.times)
+
+    def append(self, t, values):
+        """ Add a sample with time t and the values in the order of the keys"""
+        if self.times and t < self.times[-1]:
+            # Out of order samples are inserted in place to keep the times sorted
+            index = bisect.bisect_right(self.times, t)
+            self.times.insert(index, t)
+            for key, value in zip(self.keys, values):
+                self.columns[key].insert(index, value)
+        else:
+            self.times.append(t)
+            for key, value in zip(self.keys, values):
+                self.columns[key].append(value)
+        # Trim in chunks, so trimming is amortized O(1) per sample
+        if len(self.times) > 2 * self.nkeep:
+            ntrim = len(self.times) - self.nkeep
+            del self.times[:ntrim]
+            for key in self.keys:
+                del self.columns[key][:ntrim]
+
+    def lookup(self, t_ref, fields=None, interpolate=False):
+        """
+        Get a dictionary with the value of fields as of t_ref. Float
+        fields are linearly interpolated between the samples around
+        t_ref if interpolate=True. Fields are None if there is no sample
+        at or before t_ref
+        """
+        if fields is None:
+            fields = self.keys
+        index = bisect.bisect_right(self.times, t_ref) - 1
+        if index < 0:
+            return {field: None for field in fields}
+        if not interpolate or index + 1 >= len(self.times):
+            return {field: self.columns[field][index] for field in fields}
+        t0 = self.times[index]
+        t1 = self.times[index + 1]
+        w = (t_ref - t0) / (t1 - t0) if t1 > t0 else 0.0
+        values = {}
+        for field in fields:
+            v0 = self.columns[field][index]
+            v1 = self.columns[field][index + 1]
+            if isinstance(v0, float) and isinstance(v1, float):
+                values[field] = v0 + w * (v1 - v0)
+            else:
+                values[field] = v0
+        return values
+
+
+class SnapshotRecorder(threading.Thread):
+
+    """
+    Subscribe to a list of (Device, topic, Stype) with one mgr per
+    Device and a single polling loop, and keep the last nkeep samples
+    of each topic. The time of each sample is taken from the first of
+    salpylib.time_keys found in the topic, or the receive time otherwise. All
+    times (including the default t_ref of snapshot) are in the time
+    base of the SAL mgr (TAI, as private_sndStamp), see now().
+    """
+
+    def __init__(self, topics, nkeep=1000, threadID='1', tsleep=0.01):
+        threading.Thread.__init__(self)
+        self.threadID = threadID
+        self.daemon = True
+        self.tsleep = tsleep
+        self.nkeep = nkeep
+        self.running = True
+        self.lock = threading.Lock()
+        self.history = {}
+        self.time_key = {}
+        self.topics = [tuple(t) for t in topics]
+        self.subscribe()
+
+    def subscribe(self):
+        self.mgr, self.readers = salpylib.subscribe_topics(self.topics)
+        for Device, topic, myData, getSample, keys in self.readers:
+            self.add_topic(Device, topic, keys)
+
+    def add_topic(self, Device, topic, keys):
+        """ Create the history for a topic, used by record()"""
+        self.history[Device, topic] = TopicHistory(keys, nkeep=self.nkeep)
+        self.time_key[Device, topic] = salpylib.time_key(keys)
+
+    def record(self, Device, topic, values, t=None):
+        """ Add a sample as a list of values in the order of the topic keys"""
+        history = self.history[Device, topic]
+        if t is None:
+            key = self.time_key[Device, topic]
+            t = values[history.keys.index(key)] if key else self.now()
+        with self.lock:
+            history.append(t, values)
+
+    def now(self):
+        """ The current time from the SAL mgr (TAI), time.time() if there is no mgr"""
+        return salpylib.mgr_time(next(iter(self.mgr.values()), None))
+
+    def run(self):
+        """ The run method for the threading"""
+        while self.running:
+            if self.poll() == 0:
+                time.sleep(self.tsleep)
+
+    def poll(self):
+        """Read all new samples into the histories. Returns the number of samples"""
+        nsamples = 0
+        for Device, topic, myData, getSample, keys in self.readers:
+            while getSample(myData) == 0:
+                self.record(Device, topic, [salpylib.plain_value(getattr(myData, key)) for key in keys])
+                nsamples += 1
+        return nsamples
+
+    def snapshot(self, requests, t_ref=None, interpolate=False):
+        """
+        Get the values of many topics as of the same time t_ref (now() if
+        None). The requests are a list of (Device, topic, fields), with
+        fields a list of field names or None for all of them. Returns a
+        dictionary {(Device, topic): {field: value}}
+        """
+        if t_ref is None:
+            t_ref = self.now()
+        values = {}
+        with self.lock:
+            for Device, topic, fields in requests:
+                lookup = self.history[Device, topic].lookup(t_ref, fields=fields, interpolate=interpolate)
+                values.setdefault((Device, topic), {}).update(lookup)
+        return values
+
+    def shutdown(self):
+        """Stop the polling loop"""
+        self.running = False
+        if self.is_alive():
+            self.join()
+        for Device in self.mgr:
+            self.mgr[Device].salShutdown()
@@ -43,6 +43,14 @@ next_state["STOP"] = "DISABLED"
 next_state["ENTERCONTROL"] = next_state["ENTER_CONTROL"]
 next_state["EXITCONTROL"] = next_state["EXIT_CONTROL"]
 
+# The lifecycle commands that trigger the transitions above
+transition_commands = ['enterControl',
+                       'exitControl',
+                       'start',
+                       'standby',
+                       'enable',
+                       'disable']
+
 state_names = ['DISABLED',
                'ENABLED',
                'FAULT',
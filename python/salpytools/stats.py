@@ -0,0 +1,282 @@
+# This file is part of salpytools
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import math
+import time
+import bisect
+import threading
+
+"""
+Incremental (online) statistics for telemetry fields, cheap enough to
+be updated for every sample in the receive path.
+
+- RunningStats: Welford mean/variance plus min/max, mergeable
+- EWMA: Exponentially decayed average and variance
+- QuantileSketch: Mergeable sketch with relative-accuracy quantiles
+  (log-spaced buckets, as in DDSketch)
+- FieldStats: All of the above for one field, with optional tumbling
+  windows
+"""
+
+
+class RunningStats:
+
+    """ Welford mean and variance, min and max"""
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, x):
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+        if self.min is None or x < self.min:
+            self.min = x
+        if self.max is None or x > self.max:
+            self.max = x
+
+    def merge(self, other):
+        """ Combine with the stats of another stream"""
+        if other.n == 0:
+            return
+        if self.n == 0:
+            self.n, self.mean, self.m2 = other.n, other.mean, other.m2
+            self.min, self.max = other.min, other.max
+            return
+        n = self.n + other.n
+        delta = other.mean - self.mean
+        self.mean += delta * other.n / n
+        self.m2 += other.m2 + delta * delta * self.n * other.n / n
+        self.n = n
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    @property
+    def variance(self):
+        """ Sample variance, None with less than 2 samples"""
+        if self.n < 2:
+            return None
+        return self.m2 / (self.n - 1)
+
+    @property
+    def std(self):
+        variance = self.variance
+        return None if variance is None else math.sqrt(variance)
+
+
+class EWMA:
+
+    """
+    Exponentially decayed average and variance, with the weight of
+    each new sample given by alpha (or by a halflife in samples)
+    """
+
+    def __init__(self, alpha=None, halflife=None):
+        if alpha is None:
+            alpha = 1 - 0.5 ** (1.0 / halflife) if halflife else 0.1
+        self.alpha = alpha
+        self.value = None
+        self.variance = 0.0
+
+    def add(self, x):
+        if self.value is None:
+            self.value = x
+            return
+        delta = x - self.value
+        self.value += self.alpha * delta
+        self.variance = (1 - self.alpha) * (self.variance + self.alpha * delta * delta)
+
+
+class QuantileSketch:
+
+    """
+    Quantile sketch with relative accuracy: the values are counted in
+    log-spaced buckets, so any quantile is returned within a relative
+    error of relative_accuracy. Adding a value is O(1), the number of
+    buckets grows only with the log of the range of the values, and
+    two sketches with the same accuracy can be merged exactly. The bucket
+    keys are kept sorted and the cumulative counts are cached until the
+    next add, so a query is a bisect. Non-finite values are ignored.
+    """
+
+    def __init__(self, relative_accuracy=0.01):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.positive = {}
+        self.negative = {}
+        self.positive_keys = []
+        self.negative_keys = []
+        self.zero = 0
+        self.n = 0
+        # Cumulative counts and bucket values, in increasing value order
+        self.cumulative = None
+
+    def key(self, x):
+        return int(math.ceil(math.log(x) / self.log_gamma))
+
+    def count(self, buckets, keys, k, count=1):
+        if k not in buckets:
+            # The bucket must exist before its key is visible
+            buckets[k] = 0
+            bisect.insort(keys, k)
+        buckets[k] += count
+
+    def add(self, x):
+        if isinstance(x, float) and not math.isfinite(x):
+            return
+        self.n += 1
+        self.cumulative = None
+        if x > 0:
+            self.count(self.positive, self.positive_keys, self.key(x))
+        elif x < 0:
+            self.count(self.negative, self.negative_keys, self.key(-x))
+        else:
+            self.zero += 1
+
+    def merge(self, other):
+        if other.gamma != self.gamma:
+            raise ValueError("Cannot merge sketches with different relative accuracy")
+        for k, count in other.positive.items():
+            self.count(self.positive, self.positive_keys, k, count)
+        for k, count in other.negative.items():
+            self.count(self.negative, self.negative_keys, k, count)
+        self.zero += other.zero
+        self.n += other.n
+        self.cumulative = None
+
+    def value(self, k):
+        """ The representative value of bucket k"""
+        return 2 * self.gamma ** k / (self.gamma + 1)
+
+    def build_cumulative(self):
+        counts = []
+        values = []
+        count = 0
+        # From the most negative value up
+        for k in reversed(self.negative_keys):
+            count += self.negative[k]
+            counts.append(count)
+            values.append(-self.value(k))
+        if self.zero:
+            count += self.zero
+            counts.append(count)
+            values.append(0.0)
+        for k in self.positive_keys:
+            count += self.positive[k]
+            counts.append(count)
+            values.append(self.value(k))
+        self.cumulative = (counts, values)
+
+    def quantile(self, q):
+        """ Approximate q-quantile (0 <= q <= 1), None if empty"""
+        if self.n == 0:
+            return None
+        if self.cumulative is None:
+            self.build_cumulative()
+        counts, values = self.cumulative
+        # First bucket with a cumulative count over the rank
+        index = bisect.bisect_right(counts, q * (self.n - 1))
+        return values[min(index, len(values) - 1)]
+
+
+class FieldStats:
+
+    """
+    Running statistics for one field: mean, variance, min, max,
+    exponentially decayed average and a quantile sketch. If window (sec)
+    is set, the stats are reset at the start of every tumbling window
+    and the summary of the last complete window is kept in last_window.
+    Non-finite values (inf, nan) are not added to the stats, they are
+    counted in nonfinite. Values can be added from one thread (i.e.
+    DDSSubscriber) while another one gets the summary.
+    """
+
+    def __init__(self, window=None, alpha=None, halflife=None, relative_accuracy=0.01,
+                 quantiles=(0.5, 0.9, 0.99)):
+        self.window = window
+        self.alpha = alpha
+        self.halflife = halflife
+        self.relative_accuracy = relative_accuracy
+        self.quantiles = quantiles
+        self.last_window = None
+        self.lock = threading.RLock()
+        self.reset()
+
+    def reset(self, t=None):
+        with self.lock:
+            self.running = RunningStats()
+            self.ewma = EWMA(alpha=self.alpha, halflife=self.halflife)
+            self.sketch = QuantileSketch(relative_accuracy=self.relative_accuracy)
+            self.window_start = t
+            self.nonfinite = 0
+
+    def add(self, x, t=None):
+        """ Add a value received at time t (now if None)"""
+        with self.lock:
+            if self.window:
+                if t is None:
+                    t = time.time()
+                if self.window_start is None:
+                    self.window_start = t
+                elif t - self.window_start >= self.window:
+                    self.last_window = self.summary()
+                    # Align the new window to the window size
+                    self.reset(t - (t - self.window_start) % self.window)
+            if isinstance(x, float) and not math.isfinite(x):
+                self.nonfinite += 1
+                return
+            self.running.add(x)
+            self.ewma.add(x)
+            self.sketch.add(x)
+
+    def merge(self, other):
+        """ Combine with the (current window) stats of another FieldStats"""
+        with self.lock, other.lock:
+            self.running.merge(other.running)
+            self.sketch.merge(other.sketch)
+            self.nonfinite += other.nonfinite
+
+    def quantile(self, q):
+        with self.lock:
+            return self.sketch.quantile(q)
+
+    def summary(self):
+        """ Dictionary with all the stats"""
+        with self.lock:
+            summary = {'n': self.running.n,
+                       'mean': self.running.mean if self.running.n else None,
+                       'variance': self.running.variance,
+                       'std': self.running.std,
+                       'min': self.running.min,
+                       'max': self.running.max,
+                       'ewma': self.ewma.value,
+                       'ewm_variance': self.ewma.variance,
+                       'nonfinite': self.nonfinite,
+                       'window_start': self.window_start}
+            for q in self.quantiles:
+                summary['q{:g}'.format(100 * q)] = self.sketch.quantile(q)
+            return summary